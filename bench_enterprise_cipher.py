@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+benchmark of D+ enterprise version des paths
+
+usage: python bench_enterprise_cipher.py [rounds]
+"""
+
+import sys
+import timeit
+import threading
+
+import pyDes
+
+from httpdns import resolver
+from httpdns.resolver import EnterpriseCipher
+
+
+SECRET = "12345678"
+DOMAIN = "www.163.com"
+CONTENT = "1.1.1.1;2.2.2.2;3.3.3.3,600"
+
+
+def bench_pydes_per_call():
+    """
+    old path: build pyDes obj for every upstream request
+    """
+    des_obj = pyDes.des(SECRET, pyDes.ECB, padmode=pyDes.PAD_PKCS5)
+    des_obj.encrypt(DOMAIN)
+    des_obj.decrypt(ENCRYPTED_CONTENT, padmode=pyDes.PAD_PKCS5)
+
+
+def bench_enterprise_cipher():
+    """
+    EnterpriseCipher path(reused cipher obj and encrypted domain cache)
+    """
+    EnterpriseCipher.encrypt_domain(DOMAIN)
+    EnterpriseCipher.decrypt(ENCRYPTED_CONTENT)
+
+
+def use_enterprise_cipher(use_c_des):
+    """
+    reset EnterpriseCipher state
+    """
+    EnterpriseCipher._local_ = threading.local()
+    EnterpriseCipher.ENCRYPTED_DOMAIN_MAP = {}
+    EnterpriseCipher.USE_C_DES = use_c_des
+
+
+ENCRYPTED_CONTENT = pyDes.des(SECRET, pyDes.ECB, padmode=pyDes.PAD_PKCS5).encrypt(CONTENT)
+
+
+if __name__ == "__main__":
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    resolver.D_PLUS_SECRET = SECRET
+    print("rounds: %d" % rounds)
+    print("pyDes per call:   %.4fs" % timeit.timeit(bench_pydes_per_call, number=rounds))
+    use_enterprise_cipher(False)
+    print("reused pyDes:     %.4fs" % timeit.timeit(bench_enterprise_cipher, number=rounds))
+    if resolver.CDes is None:
+        print("C DES:            not installed")
+    else:
+        use_enterprise_cipher(True)
+        print("C DES:            %.4fs" % timeit.timeit(bench_enterprise_cipher, number=rounds))
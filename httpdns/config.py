@@ -24,6 +24,37 @@ D_PLUS_ID = ""
 D_PLUS_SECRET = ""
 
 
+# UPSTREAM(D+) HTTP REQUEST TIMEOUT. in seconds
+UPSTREAM_TIMEOUT = 3
+
+
+# MAX TTL OF DNS WIRE FORMAT(DoH) ANSWERS. in seconds
+# answer ttl is the time left on upstream record ttl, capped by this value
+DOH_MAX_ANSWER_TTL = 600
+
+
+# ADMISSION CONTROL OF UPSTREAM(D+) REQUESTS(cache hits are never limited)
+# limits are per process, set a rate to 0 to disable it
+#
+# token bucket per client ip bucket(request source ip masked by prefix). rate in requests/second
+# source ip is REMOTE_ADDR, or the X-Forwarded-For hop appended by the outermost trusted proxy
+# when ADMISSION_TRUSTED_PROXY_COUNT proxies(e.g. nginx) are in front of httpdns
+ADMISSION_CLIENT_RATE = 10
+ADMISSION_CLIENT_BURST = 50
+ADMISSION_CLIENT_IPV4_PREFIX = 24
+ADMISSION_CLIENT_IPV6_PREFIX = 64
+ADMISSION_TRUSTED_PROXY_COUNT = 0
+# token bucket per domain. rate in requests/second
+ADMISSION_DOMAIN_RATE = 100
+ADMISSION_DOMAIN_BURST = 500
+# max concurrent upstream requests, 0 to disable
+ADMISSION_MAX_UPSTREAM_REQUESTS = 64
+# max tracked token buckets of each kind, least recently used bucket is dropped when exceeded
+ADMISSION_MAX_BUCKETS = 100000
+# ttl of degraded answer(stale cache or BACKUP_IP_LIST) when request is over limit. in seconds
+ADMISSION_DEGRADED_TTL = 60
+
+
 # DISPATCH EXPRESS MAP
 #
 # FORMAT:
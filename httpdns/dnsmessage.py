@@ -0,0 +1,308 @@
+# -*- coding: UTF-8 -*-
+
+import re
+import socket
+import struct
+
+
+class DNSMessageError(Exception):
+    """
+    dns message format error
+    """
+    pass
+
+
+class DNSMessage(object):
+    """
+    dns wire format module(RFC 1035, with EDNS RFC 6891 and client subnet RFC 7871)
+    only single question queries are supported, answers are A/AAAA(and CNAME for dispatched domain)
+    """
+
+    TYPE_A = 1
+    TYPE_CNAME = 5
+    TYPE_AAAA = 28
+    TYPE_OPT = 41
+    CLASS_IN = 1
+
+    RCODE_NOERROR = 0
+    RCODE_FORMERR = 1
+    RCODE_SERVFAIL = 2
+    RCODE_NOTIMP = 4
+    RCODE_REFUSED = 5
+
+    EDNS_OPTION_ECS = 8
+    EDNS_UDP_PAYLOAD_SIZE = 4096
+
+    # hostname label(letters, digits, hyphen), qname is lower case
+    HOSTNAME_LABEL_PATTERN = re.compile(r"^[a-z0-9]([a-z0-9-]{0,61}[a-z0-9])?$")
+
+    # ecs family -> (socket family, address length)
+    ECS_FAMILY_MAP = {
+        1: (socket.AF_INET, 4),
+        2: (socket.AF_INET6, 16),
+    }
+
+    def __init__(self, msg_id, flags, question, qname, qtype, qclass, edns=False, ecs=None):
+        """
+        init
+        :param msg_id: message id
+        :param flags: query header flags
+        :param question: raw question section, echoed back in response
+        :param qname: lower case query domain
+        :param qtype:
+        :param qclass:
+        :param edns: whether query carries an OPT record
+        :param ecs: client subnet option, (family, source_prefix, address) or None
+        :return: None
+        """
+        self.msg_id = msg_id
+        self.flags = flags
+        self.question = question
+        self.qname = qname
+        self.qtype = qtype
+        self.qclass = qclass
+        self.edns = edns
+        self.ecs = ecs
+
+    @property
+    def opcode(self):
+        """
+        query opcode
+        :return: int
+        """
+        return (self.flags >> 11) & 0xF
+
+    @classmethod
+    def parse_query(cls, data):
+        """
+        parse dns query message
+        :param data: raw dns message
+        :return: DNSMessage obj
+        """
+        try:
+            return cls._parse_query_(data)
+        except struct.error:
+            raise DNSMessageError("truncated message")
+
+    @classmethod
+    def _parse_query_(cls, data):
+        """
+        parse dns query message, struct.error is raised on truncated data
+        :param data: raw dns message
+        :return: DNSMessage obj
+        """
+        msg_id, flags, qdcount, ancount, nscount, arcount = struct.unpack_from("!6H", data, 0)
+        if flags & 0x8000:
+            raise DNSMessageError("message is not a query")
+        if qdcount != 1:
+            raise DNSMessageError("only single question is supported")
+        qname, offset = cls._read_name_(data, 12)
+        qtype, qclass = struct.unpack_from("!HH", data, offset)
+        offset += 4
+        question = data[12:offset]
+        for _ in range(ancount + nscount):
+            offset = cls._read_record_(data, offset)[-1]
+        edns, ecs = False, None
+        for _ in range(arcount):
+            _rtype, _rdata, offset = cls._read_record_(data, offset)
+            if _rtype == cls.TYPE_OPT:
+                if edns:
+                    raise DNSMessageError("multiple OPT records")
+                edns = True
+                ecs = cls._read_ecs_(_rdata)
+        return cls(msg_id, flags, question, qname, qtype, qclass, edns, ecs)
+
+    @classmethod
+    def build_format_error(cls, data):
+        """
+        build FORMERR response for a query which can't be parsed
+        :param data: raw dns message
+        :return: raw dns message, or None if the header isn't readable or message isn't a query
+        """
+        try:
+            msg_id, flags = struct.unpack_from("!HH", data, 0)
+        except struct.error:
+            return None
+        if len(data) < 12 or flags & 0x8000:
+            return None
+        # QR + RA, keep opcode, RD and CD from query
+        flags = 0x8000 | 0x0080 | (flags & 0x7910) | cls.RCODE_FORMERR
+        return struct.pack("!6H", msg_id, flags, 0, 0, 0, 0)
+
+    def is_hostname_query(self):
+        """
+        check qname is a hostname(not root, only LDH labels)
+        qname is used as cache db name, so other names must not reach the resolver
+        :return: True or False
+        """
+        if not self.qname:
+            return False
+        for label in self.qname.split("."):
+            if not self.HOSTNAME_LABEL_PATTERN.match(label):
+                return False
+        return True
+
+    def get_client_subnet_ip(self):
+        """
+        get client ip from edns client subnet option
+        source prefix 0 means the client asked not to use its address, so None is returned
+        :return: ip str or None
+        """
+        if self.ecs is None:
+            return None
+        family, source_prefix, address = self.ecs
+        if source_prefix == 0:
+            return None
+        _socket_family, _address_len = self.ECS_FAMILY_MAP[family]
+        address += b"\x00" * (_address_len - len(address))
+        return socket.inet_ntop(_socket_family, address)
+
+    def build_response(self, server_ip_list, ttl, domain=None, rcode=RCODE_NOERROR):
+        """
+        build dns response message
+        if domain differs from qname, a CNAME(qname -> domain) is prepended to the answers
+        :param server_ip_list: ip list, ip of other family than qtype is skipped
+        :param ttl: answer ttl
+        :param domain: dispatched domain
+        :param rcode:
+        :return: raw dns message
+        """
+        ttl = max(0, min(int(ttl), 0x7FFFFFFF))
+        answers = []
+        if rcode == self.RCODE_NOERROR and self.qtype in (self.TYPE_A, self.TYPE_AAAA):
+            # question name always starts at offset 12
+            owner = struct.pack("!H", 0xC00C)
+            if domain and domain != self.qname:
+                target = self._encode_name_(domain)
+                answers.append(owner + struct.pack("!HHIH", self.TYPE_CNAME, self.CLASS_IN, ttl, len(target)) + target)
+                owner = struct.pack("!H", 0xC000 | (12 + len(self.question) + 12))
+            if self.qtype == self.TYPE_A:
+                _socket_family = socket.AF_INET
+            else:
+                _socket_family = socket.AF_INET6
+            for ip in server_ip_list:
+                try:
+                    rdata = socket.inet_pton(_socket_family, ip)
+                except (socket.error, ValueError, TypeError):
+                    continue
+                answers.append(owner + struct.pack("!HHIH", self.qtype, self.CLASS_IN, ttl, len(rdata)) + rdata)
+        additional = []
+        if self.edns:
+            options = b""
+            if self.ecs is not None:
+                family, source_prefix, address = self.ecs
+                # answers are cached per client ip, so scope is the full source prefix
+                _ecs_data = struct.pack("!HBB", family, source_prefix, source_prefix) + address
+                options = struct.pack("!HH", self.EDNS_OPTION_ECS, len(_ecs_data)) + _ecs_data
+            additional.append(b"\x00" + struct.pack("!HHIH", self.TYPE_OPT, self.EDNS_UDP_PAYLOAD_SIZE, 0,
+                                                    len(options)) + options)
+        # QR + RA, keep opcode, RD and CD from query
+        flags = 0x8000 | 0x0080 | (self.flags & 0x7910) | (rcode & 0xF)
+        header = struct.pack("!6H", self.msg_id, flags, 1, len(answers), 0, len(additional))
+        return header + self.question + b"".join(answers) + b"".join(additional)
+
+    @classmethod
+    def _read_name_(cls, data, offset):
+        """
+        read domain name, compression pointer is supported
+        :param data: raw dns message
+        :param offset: name start offset
+        :return: lower case domain, offset after name
+        """
+        labels = []
+        end_offset = None
+        jumps = 0
+        while True:
+            length, = struct.unpack_from("!B", data, offset)
+            if length & 0xC0 == 0xC0:
+                pointer, = struct.unpack_from("!H", data, offset)
+                if end_offset is None:
+                    end_offset = offset + 2
+                jumps += 1
+                if jumps > 16:
+                    raise DNSMessageError("compression pointer loop")
+                offset = pointer & 0x3FFF
+                continue
+            if length & 0xC0:
+                raise DNSMessageError("unsupported label type")
+            offset += 1
+            if length == 0:
+                break
+            label = data[offset:offset + length]
+            if len(label) != length:
+                raise struct.error("label out of range")
+            labels.append(label)
+            offset += length
+        if end_offset is None:
+            end_offset = offset
+        name = b".".join(labels)
+        if len(name) > 253:
+            raise DNSMessageError("domain too long")
+        try:
+            name = str(name.decode("ascii")).lower()
+        except UnicodeDecodeError:
+            raise DNSMessageError("domain is not ascii")
+        return name, end_offset
+
+    @classmethod
+    def _read_record_(cls, data, offset):
+        """
+        read resource record
+        :param data: raw dns message
+        :param offset: record start offset
+        :return: rtype, rdata, offset after record
+        """
+        offset = cls._read_name_(data, offset)[1]
+        rtype, _rclass, _rttl, rdlength = struct.unpack_from("!HHIH", data, offset)
+        offset += 10
+        rdata = data[offset:offset + rdlength]
+        if len(rdata) != rdlength:
+            raise struct.error("rdata out of range")
+        return rtype, rdata, offset + rdlength
+
+    @classmethod
+    def _read_ecs_(cls, rdata):
+        """
+        read client subnet option from OPT record rdata
+        :param rdata:
+        :return: (family, source_prefix, address) or None
+        """
+        offset = 0
+        while offset < len(rdata):
+            code, length = struct.unpack_from("!HH", rdata, offset)
+            offset += 4
+            option = rdata[offset:offset + length]
+            offset += length
+            if len(option) != length:
+                raise struct.error("option out of range")
+            if code != cls.EDNS_OPTION_ECS:
+                continue
+            family, source_prefix, _scope_prefix = struct.unpack_from("!HBB", option, 0)
+            address = option[4:]
+            if family not in cls.ECS_FAMILY_MAP:
+                raise DNSMessageError("unsupported client subnet family")
+            _address_len = cls.ECS_FAMILY_MAP[family][1]
+            if source_prefix > _address_len * 8 or len(address) != (source_prefix + 7) // 8:
+                raise DNSMessageError("invalid client subnet")
+            # address bits beyond source prefix must be zero(RFC 7871 7.1.2)
+            if source_prefix % 8:
+                _last_byte, = struct.unpack_from("!B", address, len(address) - 1)
+                if _last_byte & (0xFF >> (source_prefix % 8)):
+                    raise DNSMessageError("client subnet address has bits beyond source prefix")
+            return family, source_prefix, address
+        return None
+
+    @classmethod
+    def _encode_name_(cls, domain):
+        """
+        encode domain to wire format
+        :param domain:
+        :return: raw name
+        """
+        name = b""
+        for label in domain.strip(".").split("."):
+            label = label.encode("ascii")
+            if not label or len(label) > 63:
+                raise DNSMessageError("invalid domain label")
+            name += struct.pack("!B", len(label)) + label
+        return name + b"\x00"
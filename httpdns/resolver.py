@@ -6,13 +6,25 @@ import time
 import json
 import copy
 import urllib
+import socket
+import threading
+from collections import OrderedDict
 
 import leveldb
 import requests
 import pyDes
 
+try:
+    # C accelerated DES(pycryptodome or pycrypto), optional
+    from Crypto.Cipher import DES as CDes
+except ImportError:
+    CDes = None
+
 from httpdns.config import BACKUP_IP_LIST, D_PLUS_ID, D_PLUS_SECRET, D_PLUS_ENTERPRISE_VERSION
 from httpdns.config import DISPATCH_RULE, EXPR_MAP, DB_PATH, DEFAULT_DOMAIN_CACHE_TTL
+from httpdns.config import ADMISSION_CLIENT_RATE, ADMISSION_CLIENT_BURST, ADMISSION_DOMAIN_RATE, ADMISSION_DOMAIN_BURST
+from httpdns.config import ADMISSION_CLIENT_IPV4_PREFIX, ADMISSION_CLIENT_IPV6_PREFIX, ADMISSION_MAX_UPSTREAM_REQUESTS
+from httpdns.config import ADMISSION_MAX_BUCKETS, ADMISSION_DEGRADED_TTL, UPSTREAM_TIMEOUT
 
 
 class RpcFormatter(object):
@@ -44,19 +56,27 @@ class DNSResolver(object):
     dns resolve module
     """
 
-    def __init__(self, domain, client_ip=None, client_extra_info=None, ttl=None):
+    def __init__(self, domain, client_ip=None, client_extra_info=None, ttl=None, record_ttl=False,
+                 source_ip=None):
         """
         init
         :param domain:  request domain
         :param client_ip: request client ip
         :param client_extra_info: http get params dict(request.GET.dict())
         :param ttl:  domain ttl
+        :param record_ttl: if True, ttl is the time left on upstream record ttl instead of cache ttl
+        :param source_ip: request source ip(not supplied by client), used for admission control.
+                          default is client_ip
         :return: None
         """
         self.domain = domain
         self.client_ip = client_ip
         self.client_extra_info = client_extra_info or dict()
         self.ttl = ttl
+        self.record_ttl = record_ttl
+        self.source_ip = source_ip
+        if self.source_ip is None:
+            self.source_ip = client_ip
         if self.ttl is None:
             self.ttl = 1
 
@@ -66,25 +86,58 @@ class DNSResolver(object):
         resolve dns
         :return: server_ip_list, ttl, domain
         """
+        return self.resolve_record()
+
+    def resolve_record(self):
+        """
+        resolve dns without rpc format(used by dns wire format endpoint)
+        :return: server_ip_list, ttl, domain
+        """
         dispatch_rule = CacheController.get_dispatch_rule_cache(self.domain)
         dispatcher = Dispatcher(self.client_extra_info, dispatch_rule)
         domain = dispatcher.get_dispatched_domain()
         if domain is None:
             domain = self.domain
         server_ip_list, ttl = CacheController.get_resolve_cache(domain, self.client_ip, 
-                                                                ttl=self.ttl)
+                                                                ttl=self.ttl, record_ttl=self.record_ttl)
         if server_ip_list is not None:
+            AdmissionController.incr_counter("cache_hit")
             return server_ip_list, ttl, domain
-        if D_PLUS_ENTERPRISE_VERSION:
-            server_ip_list, ttl = self._enterprise_version_resolver_(domain, self.client_ip)
-        else:
-            server_ip_list, ttl = self._base_resolver_(domain, self.client_ip)
+        if not AdmissionController.acquire(domain, self.source_ip):
+            server_ip_list, ttl = self._degraded_resolver_(domain, self.client_ip)
+            return server_ip_list, ttl, domain
+        try:
+            if D_PLUS_ENTERPRISE_VERSION:
+                server_ip_list, ttl = self._enterprise_version_resolver_(domain, self.client_ip)
+            else:
+                server_ip_list, ttl = self._base_resolver_(domain, self.client_ip)
+        finally:
+            AdmissionController.release()
         if server_ip_list is None or ttl is None:
             server_ip_list, ttl = [], 0
         else:
-            CacheController.set_resolve_cache(domain, self.client_ip, server_ip_list)
+            CacheController.set_resolve_cache(domain, self.client_ip, server_ip_list, ttl)
         return server_ip_list, ttl, domain
 
+    @classmethod
+    def _degraded_resolver_(cls, domain, client_ip):
+        """
+        resolve when upstream request is rejected by AdmissionController
+        stale cache first, then BACKUP_IP_LIST
+        :param domain:
+        :param client_ip:
+        :return: server_ip_list, ttl
+        """
+        server_ip_list = CacheController.get_stale_resolve_cache(domain, client_ip)
+        if server_ip_list:
+            AdmissionController.incr_counter("degraded_stale")
+            return server_ip_list, ADMISSION_DEGRADED_TTL
+        if BACKUP_IP_LIST:
+            AdmissionController.incr_counter("degraded_backup")
+            return list(BACKUP_IP_LIST), ADMISSION_DEGRADED_TTL
+        AdmissionController.incr_counter("degraded_empty")
+        return [], 0
+
     @classmethod
     def _base_resolver_(cls, domain, client_ip):
         """
@@ -98,12 +151,14 @@ class DNSResolver(object):
         url = "http://119.29.29.29/d?" + urllib.urlencode(params)
         _server_ip_list, _ttl = None, None
         try:
-            res = requests.get(url)
+            res = requests.get(url, timeout=UPSTREAM_TIMEOUT)
             if res.status_code == 200 and res.content:
                 _ip_str, _ttl = res.content.split(",")
+                _ttl = int(_ttl)
                 _server_ip_list = _ip_str.split(";")
         except:
-            return _server_ip_list, _ttl
+            pass
+        return _server_ip_list, _ttl
 
     @classmethod
     def _enterprise_version_resolver_(cls, domain, client_ip):
@@ -114,19 +169,262 @@ class DNSResolver(object):
         :param client_ip:
         :return:
         """
-        des_obj = pyDes.des(D_PLUS_SECRET, pyDes.ECB, padmode=pyDes.PAD_PKCS5)
-        domain = des_obj.encrypt(domain)
+        domain = EnterpriseCipher.encrypt_domain(domain)
         params = {"dn": domain, "id": D_PLUS_ID, "ip": client_ip, "ttl": 1}
         url = "http://119.29.29.29/d?" + urllib.urlencode(params)
         _server_ip_list, _ttl = None, None
         try:    
-            res = requests.get(url)
+            res = requests.get(url, timeout=UPSTREAM_TIMEOUT)
             if res.status_code == 200 and res.content:
-                content = des_obj.decrypt(res.content, padmode=pyDes.PAD_PKCS5)
+                content = EnterpriseCipher.decrypt(res.content)
                 _ip_str, _ttl = content.split(",")
+                _ttl = int(_ttl)
                 _server_ip_list = _ip_str.split(";")
         except:
-            return _server_ip_list, _ttl
+            pass
+        return _server_ip_list, _ttl
+
+
+class EnterpriseCipher(object):
+    """
+    D+ enterprise version des module(DES ECB, PKCS5 padding, key is D_PLUS_SECRET)
+    cipher obj is built once per thread(pyDes obj keeps state while crypting, so it can't be shared),
+    uses C accelerated DES when installed and compatible with pyDes, otherwise pyDes
+    """
+
+    # thread local cipher obj
+    _local_ = threading.local()
+
+    # encrypted domain cache, domain -> encrypted domain
+    ENCRYPTED_DOMAIN_MAP = {}
+    ENCRYPTED_DOMAIN_MAP_MAX_SIZE = 10000
+
+    # known answer test vector, checks C DES output against pyDes
+    TEST_VECTOR = "www.163.com"
+
+    # None: not checked yet, True/False: C DES is used or not
+    USE_C_DES = None
+
+    @classmethod
+    def encrypt_domain(cls, domain):
+        """
+        encrypt domain, result is cached
+        :param domain:
+        :return: encrypted domain
+        """
+        encrypted_domain = cls.ENCRYPTED_DOMAIN_MAP.get(domain)
+        if encrypted_domain is not None:
+            return encrypted_domain
+        encrypted_domain = cls.encrypt(domain)
+        if len(cls.ENCRYPTED_DOMAIN_MAP) >= cls.ENCRYPTED_DOMAIN_MAP_MAX_SIZE:
+            cls.ENCRYPTED_DOMAIN_MAP.clear()
+        cls.ENCRYPTED_DOMAIN_MAP[domain] = encrypted_domain
+        return encrypted_domain
+
+    @classmethod
+    def encrypt(cls, data):
+        """
+        encrypt with PKCS5 padding
+        :param data:
+        :return: str
+        """
+        _pad = 8 - len(data) % 8
+        return cls._get_cipher_().encrypt(data + chr(_pad) * _pad)
+
+    @classmethod
+    def decrypt(cls, data):
+        """
+        decrypt and remove PKCS5 padding
+        :param data:
+        :return: str
+        """
+        if not data or len(data) % 8:
+            raise ValueError("data length must be a multiple of 8")
+        content = cls._get_cipher_().decrypt(data)
+        _pad = ord(content[-1])
+        if not 1 <= _pad <= 8 or content[-_pad:] != content[-1] * _pad:
+            raise ValueError("invalid padding")
+        return content[:-_pad]
+
+    @classmethod
+    def _get_cipher_(cls):
+        """
+        get thread local cipher obj(without padding, PKCS5 padding is done by caller), build it on first use
+        :return: C DES obj or pyDes obj
+        """
+        cipher = getattr(cls._local_, "cipher", None)
+        if cipher is not None:
+            return cipher
+        if cls.USE_C_DES is None:
+            cls.USE_C_DES = cls._check_c_des_()
+        if cls.USE_C_DES:
+            cipher = CDes.new(D_PLUS_SECRET, CDes.MODE_ECB)
+        else:
+            cipher = pyDes.des(D_PLUS_SECRET, pyDes.ECB)
+        cls._local_.cipher = cipher
+        return cipher
+
+    @classmethod
+    def _check_c_des_(cls):
+        """
+        check C DES is installed and gives the same result as pyDes
+        :return: True or False
+        """
+        if CDes is None:
+            return False
+        try:
+            c_cipher = CDes.new(D_PLUS_SECRET, CDes.MODE_ECB)
+            _pad = 8 - len(cls.TEST_VECTOR) % 8
+            c_result = c_cipher.encrypt(cls.TEST_VECTOR + chr(_pad) * _pad)
+        except (ValueError, TypeError):
+            return False
+        py_cipher = pyDes.des(D_PLUS_SECRET, pyDes.ECB, padmode=pyDes.PAD_PKCS5)
+        return c_result == py_cipher.encrypt(cls.TEST_VECTOR)
+
+
+class AdmissionController(object):
+    """
+    admission control module for upstream requests(cache misses)
+    token bucket per client ip bucket and per domain, and a cap of concurrent upstream requests.
+    state and counters are per process
+    """
+
+    # lock of buckets and upstream requests
+    _lock_ = threading.Lock()
+    # lock of counters, cache hits only take this one
+    _counter_lock_ = threading.Lock()
+
+    # key -> [tokens, last refill timestamp], least recently used first
+    CLIENT_BUCKET_MAP = OrderedDict()
+    DOMAIN_BUCKET_MAP = OrderedDict()
+
+    # client bucket key shared by all source ip which can't be parsed
+    INVALID_CLIENT_BUCKET_KEY = "invalid"
+
+    # current upstream requests
+    UPSTREAM_REQUESTS = 0
+
+    COUNTERS = {
+        "cache_hit": 0,
+        "upstream_admitted": 0,
+        "shed_concurrency": 0,
+        "shed_client_rate": 0,
+        "shed_domain_rate": 0,
+        "degraded_stale": 0,
+        "degraded_backup": 0,
+        "degraded_empty": 0,
+    }
+
+    @classmethod
+    def acquire(cls, domain, source_ip):
+        """
+        acquire an upstream request slot, release() must be called after upstream request if admitted
+        tokens are taken only when both client and domain bucket have one
+        :param domain:
+        :param source_ip: request source ip(not supplied by client)
+        :return: True(admitted) or False(rejected)
+        """
+        now = time.time()
+        client_key = cls._get_client_bucket_key_(source_ip)
+        counter_name = "upstream_admitted"
+        with cls._lock_:
+            if 0 < ADMISSION_MAX_UPSTREAM_REQUESTS <= cls.UPSTREAM_REQUESTS:
+                counter_name = "shed_concurrency"
+            else:
+                client_bucket = cls._refill_(cls.CLIENT_BUCKET_MAP, client_key, ADMISSION_CLIENT_RATE,
+                                             ADMISSION_CLIENT_BURST, now)
+                domain_bucket = cls._refill_(cls.DOMAIN_BUCKET_MAP, domain, ADMISSION_DOMAIN_RATE,
+                                             ADMISSION_DOMAIN_BURST, now)
+                if client_bucket is not None and client_bucket[0] < 1:
+                    counter_name = "shed_client_rate"
+                elif domain_bucket is not None and domain_bucket[0] < 1:
+                    counter_name = "shed_domain_rate"
+                else:
+                    for bucket in (client_bucket, domain_bucket):
+                        if bucket is not None:
+                            bucket[0] -= 1
+                    cls.UPSTREAM_REQUESTS += 1
+        cls.incr_counter(counter_name)
+        return counter_name == "upstream_admitted"
+
+    @classmethod
+    def release(cls):
+        """
+        release an upstream request slot
+        :return: None
+        """
+        with cls._lock_:
+            cls.UPSTREAM_REQUESTS -= 1
+
+    @classmethod
+    def incr_counter(cls, name):
+        """
+        increase counter
+        :param name: counter name
+        :return: None
+        """
+        with cls._counter_lock_:
+            cls.COUNTERS[name] = cls.COUNTERS.get(name, 0) + 1
+
+    @classmethod
+    def get_counters(cls):
+        """
+        get counters and current state
+        :return: dict
+        """
+        with cls._counter_lock_:
+            counters = dict(cls.COUNTERS)
+        with cls._lock_:
+            counters["upstream_requests"] = cls.UPSTREAM_REQUESTS
+            counters["client_buckets"] = len(cls.CLIENT_BUCKET_MAP)
+            counters["domain_buckets"] = len(cls.DOMAIN_BUCKET_MAP)
+        return counters
+
+    @classmethod
+    def _refill_(cls, bucket_map, key, rate, burst, now):
+        """
+        get token bucket and refill it, must be called with lock held
+        least recently used bucket is dropped when ADMISSION_MAX_BUCKETS is reached
+        :param bucket_map: key -> [tokens, last refill timestamp], least recently used first
+        :param key: bucket key
+        :param rate: tokens per second, 0 means unlimited
+        :param burst: bucket size
+        :param now: timestamp
+        :return: bucket or None(unlimited)
+        """
+        if rate <= 0:
+            return None
+        bucket = bucket_map.pop(key, None)
+        if bucket is None:
+            if len(bucket_map) >= ADMISSION_MAX_BUCKETS:
+                bucket_map.popitem(last=False)
+            bucket = [burst, now]
+        else:
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        bucket_map[key] = bucket
+        return bucket
+
+    @classmethod
+    def _get_client_bucket_key_(cls, client_ip):
+        """
+        get client bucket key, client ip masked by ADMISSION_CLIENT_IPV4_PREFIX/ADMISSION_CLIENT_IPV6_PREFIX
+        all client ip which can't be parsed share INVALID_CLIENT_BUCKET_KEY
+        :param client_ip:
+        :return: str
+        """
+        client_ip = str(client_ip)
+        for family, prefix in ((socket.AF_INET, ADMISSION_CLIENT_IPV4_PREFIX),
+                               (socket.AF_INET6, ADMISSION_CLIENT_IPV6_PREFIX)):
+            try:
+                address = bytearray(socket.inet_pton(family, client_ip))
+            except (socket.error, ValueError):
+                continue
+            for i in range(len(address)):
+                _bits = min(8, max(0, prefix - i * 8))
+                address[i] &= (0xFF << (8 - _bits)) & 0xFF
+            return "%s/%d" % (socket.inet_ntop(family, bytes(address)), prefix)
+        return cls.INVALID_CLIENT_BUCKET_KEY
 
 
 class Dispatcher(object):
@@ -313,35 +611,47 @@ class CacheController(object):
     CACHE_CONN_MAP = {}
 
     @classmethod
-    def get_resolve_cache(cls, domain, client_ip, ttl):
+    def get_resolve_cache(cls, domain, client_ip, ttl, record_ttl=False):
         """
         get domain resolve cache
         :param domain:
         :param client_ip:
         :param ttl:
+        :param record_ttl: if True, check and return the time left on upstream record ttl instead of cache ttl
         :return: server_ip_list, ttl
         """
-        cache_conn = cls._get_cache_conn_(domain)
-        cache_key = cls._get_resolve_cache_key_(domain, client_ip)
-        try:
-            cache_data = cache_conn.Get(cache_key)
-            cache_data = json.loads(cache_data)
-        except KeyError:
-            return None, None
-        except ValueError:
+        cache_data = cls._get_resolve_cache_data_(domain, client_ip)
+        if cache_data is None:
             return None, None
         _ttl = DEFAULT_DOMAIN_CACHE_TTL - (time.time() - cache_data["timestamp"])
+        if record_ttl:
+            # cache written before upstream ttl was saved has no "ttl"
+            _ttl = min(_ttl, (cache_data.get("ttl") or 0) - (time.time() - cache_data["timestamp"]))
         if _ttl < ttl:
             return None, None
         return cache_data["server_ip_list"], int(_ttl)
 
     @classmethod
-    def set_resolve_cache(cls, domain, client_ip, server_ip_list):
+    def get_stale_resolve_cache(cls, domain, client_ip):
+        """
+        get domain resolve cache even if it's expired
+        :param domain:
+        :param client_ip:
+        :return: server_ip_list or None
+        """
+        cache_data = cls._get_resolve_cache_data_(domain, client_ip)
+        if cache_data is None:
+            return None
+        return cache_data["server_ip_list"]
+
+    @classmethod
+    def set_resolve_cache(cls, domain, client_ip, server_ip_list, ttl=None):
         """
         set domain resolve cache
         :param domain:
         :param client_ip:
         :param server_ip_list:
+        :param ttl: upstream record ttl
         :return: Always return True
         """
         cache_conn = cls._get_cache_conn_(domain)
@@ -349,6 +659,7 @@ class CacheController(object):
         cache_data = {
             "timestamp": time.time(),
             "server_ip_list": server_ip_list,
+            "ttl": ttl,
         }
         cache_data = json.dumps(cache_data)
         cache_conn.Put(cache_key, cache_data)
@@ -449,6 +760,24 @@ class CacheController(object):
         cls.CACHE_CONN_MAP[domain] = cache_conn
         return cache_conn
 
+    @classmethod
+    def _get_resolve_cache_data_(cls, domain, client_ip):
+        """
+        get domain resolve cache record
+        :param domain:
+        :param client_ip:
+        :return: dict or None
+        """
+        cache_conn = cls._get_cache_conn_(domain)
+        cache_key = cls._get_resolve_cache_key_(domain, client_ip)
+        try:
+            cache_data = cache_conn.Get(cache_key)
+            return json.loads(cache_data)
+        except KeyError:
+            return None
+        except ValueError:
+            return None
+
     @classmethod
     def _get_resolve_cache_key_(cls, domain, client_ip):
         """
@@ -0,0 +1,475 @@
+# -*- coding: UTF-8 -*-
+
+import time
+import json
+import binascii
+import threading
+import unittest
+from collections import OrderedDict
+
+import pyDes
+
+from httpdns import resolver, views
+from httpdns.resolver import EnterpriseCipher, AdmissionController, DNSResolver, CacheController
+from httpdns.dnsmessage import DNSMessage, DNSMessageError
+
+
+class DNSMessageTest(unittest.TestCase):
+    """
+    DNSMessage test
+    """
+
+    # id 0x1234, RD
+    HEADER = b"\x12\x34\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00"
+    # id 0x1234, RD, one additional record
+    EDNS_HEADER = b"\x12\x34\x01\x00\x00\x01\x00\x00\x00\x00\x00\x01"
+    # WwW.163.com
+    QNAME = b"\x03WwW\x03163\x03com\x00"
+    A_QUESTION = QNAME + b"\x00\x01\x00\x01"
+    AAAA_QUESTION = QNAME + b"\x00\x1c\x00\x01"
+    # OPT record header, payload size 4096, rdata length follows
+    OPT = b"\x00\x00\x29\x10\x00\x00\x00\x00\x00"
+    # client subnet 1.2.3.0/24
+    ECS_V4 = OPT + b"\x00\x0b" + b"\x00\x08\x00\x07\x00\x01\x18\x00\x01\x02\x03"
+    # client subnet 2001:db8:1::/56
+    ECS_V6 = OPT + b"\x00\x0f" + b"\x00\x08\x00\x0b\x00\x02\x38\x00\x20\x01\x0d\xb8\x00\x01\x00"
+    # client subnet 0.0.0.0/0
+    ECS_PREFIX_0 = OPT + b"\x00\x08" + b"\x00\x08\x00\x04\x00\x01\x00\x00"
+    # client subnet 1.2.3.0/23, bit beyond source prefix is set
+    ECS_DIRTY = OPT + b"\x00\x0b" + b"\x00\x08\x00\x07\x00\x01\x17\x00\x01\x02\x03"
+
+    def test_parse_a_query(self):
+        message = DNSMessage.parse_query(self.EDNS_HEADER + self.A_QUESTION + self.ECS_V4)
+        self.assertEqual(message.msg_id, 0x1234)
+        self.assertEqual(message.qname, "www.163.com")
+        self.assertEqual(message.qtype, DNSMessage.TYPE_A)
+        self.assertEqual(message.qclass, DNSMessage.CLASS_IN)
+        self.assertEqual(message.opcode, 0)
+        self.assertEqual(message.question, self.A_QUESTION)
+        self.assertTrue(message.edns)
+        self.assertEqual(message.get_client_subnet_ip(), "1.2.3.0")
+
+    def test_parse_aaaa_query(self):
+        message = DNSMessage.parse_query(self.EDNS_HEADER + self.AAAA_QUESTION + self.ECS_V6)
+        self.assertEqual(message.qtype, DNSMessage.TYPE_AAAA)
+        self.assertEqual(message.get_client_subnet_ip(), "2001:db8:1::")
+
+    def test_parse_without_edns(self):
+        message = DNSMessage.parse_query(self.HEADER + self.A_QUESTION)
+        self.assertFalse(message.edns)
+        self.assertIsNone(message.get_client_subnet_ip())
+
+    def test_ecs_prefix_0(self):
+        message = DNSMessage.parse_query(self.EDNS_HEADER + self.A_QUESTION + self.ECS_PREFIX_0)
+        self.assertEqual(message.ecs, (1, 0, b""))
+        self.assertIsNone(message.get_client_subnet_ip())
+
+    def test_invalid_edns(self):
+        # bits beyond source prefix
+        self.assertRaises(DNSMessageError, DNSMessage.parse_query,
+                          self.EDNS_HEADER + self.A_QUESTION + self.ECS_DIRTY)
+        # multiple OPT records
+        header = b"\x12\x34\x01\x00\x00\x01\x00\x00\x00\x00\x00\x02"
+        self.assertRaises(DNSMessageError, DNSMessage.parse_query,
+                          header + self.A_QUESTION + self.ECS_V4 + self.ECS_V4)
+
+    def test_truncated(self):
+        data = self.EDNS_HEADER + self.A_QUESTION + self.ECS_V4
+        for length in (5, 12, 20, len(data) - 3):
+            self.assertRaises(DNSMessageError, DNSMessage.parse_query, data[:length])
+
+    def test_compression_pointer_loop(self):
+        self.assertRaises(DNSMessageError, DNSMessage.parse_query,
+                          self.HEADER + b"\xc0\x0c\x00\x01\x00\x01")
+
+    def test_format_error(self):
+        self.assertEqual(DNSMessage.build_format_error(self.HEADER + b"\x03WwW"),
+                         b"\x12\x34\x81\x81\x00\x00\x00\x00\x00\x00\x00\x00")
+        self.assertIsNone(DNSMessage.build_format_error(self.HEADER[:5]))
+        # response is not answered
+        self.assertIsNone(DNSMessage.build_format_error(b"\x12\x34\x81\x00" + self.HEADER[4:]))
+
+    def test_a_response(self):
+        message = DNSMessage.parse_query(self.HEADER + self.A_QUESTION)
+        content = message.build_response(["1.1.1.1", "::1", "2.2.2.2"], 300)
+        self.assertEqual(content, b"\x12\x34\x81\x80\x00\x01\x00\x02\x00\x00\x00\x00" + self.A_QUESTION +
+                         b"\xc0\x0c\x00\x01\x00\x01\x00\x00\x01\x2c\x00\x04\x01\x01\x01\x01" +
+                         b"\xc0\x0c\x00\x01\x00\x01\x00\x00\x01\x2c\x00\x04\x02\x02\x02\x02")
+
+    def test_aaaa_response(self):
+        message = DNSMessage.parse_query(self.HEADER + self.AAAA_QUESTION)
+        content = message.build_response(["1.1.1.1", "2001:db8::1"], 300)
+        self.assertEqual(content, b"\x12\x34\x81\x80\x00\x01\x00\x01\x00\x00\x00\x00" + self.AAAA_QUESTION +
+                         b"\xc0\x0c\x00\x1c\x00\x01\x00\x00\x01\x2c\x00\x10" +
+                         b"\x20\x01\x0d\xb8" + b"\x00" * 11 + b"\x01")
+
+    def test_cname_response(self):
+        message = DNSMessage.parse_query(self.EDNS_HEADER + self.A_QUESTION + self.ECS_V4)
+        content = message.build_response(["1.1.1.1"], 300, "mirrors.163.com")
+        # CNAME target follows question, CNAME owner pointer and 10 bytes of type/class/ttl/rdlength
+        target_offset = 12 + len(message.question) + 12
+        self.assertEqual(target_offset, 0x29)
+        self.assertEqual(content, b"\x12\x34\x81\x80\x00\x01\x00\x02\x00\x00\x00\x01" + self.A_QUESTION +
+                         b"\xc0\x0c\x00\x05\x00\x01\x00\x00\x01\x2c\x00\x11\x07mirrors\x03163\x03com\x00" +
+                         b"\xc0\x29\x00\x01\x00\x01\x00\x00\x01\x2c\x00\x04\x01\x01\x01\x01" +
+                         self.OPT + b"\x00\x0b\x00\x08\x00\x07\x00\x01\x18\x18\x01\x02\x03")
+
+    def test_flags(self):
+        # opcode 2(status), RD, CD
+        message = DNSMessage.parse_query(b"\x12\x34\x11\x10" + self.HEADER[4:] + self.A_QUESTION)
+        self.assertEqual(message.opcode, 2)
+        content = message.build_response([], 0, rcode=DNSMessage.RCODE_NOTIMP)
+        self.assertEqual(content[:12], b"\x12\x34\x91\x94\x00\x01\x00\x00\x00\x00\x00\x00")
+        # response is rejected
+        self.assertRaises(DNSMessageError, DNSMessage.parse_query,
+                          b"\x12\x34\x81\x00" + self.HEADER[4:] + self.A_QUESTION)
+
+    def test_is_hostname_query(self):
+        def _message_(qname):
+            return DNSMessage.parse_query(self.HEADER + qname + b"\x00\x01\x00\x01")
+        self.assertTrue(_message_(self.QNAME).is_hostname_query())
+        self.assertTrue(_message_(b"\x05a-b-c\x03com\x00").is_hostname_query())
+        self.assertFalse(_message_(b"\x00").is_hostname_query())
+        self.assertFalse(_message_(b"\x06_dmarc\x03com\x00").is_hostname_query())
+        self.assertFalse(_message_(b"\x04-abc\x03com\x00").is_hostname_query())
+        self.assertFalse(_message_(b"\x03a/b\x03com\x00").is_hostname_query())
+        # label over 63 bytes can't be encoded on the wire, check it by qname
+        self.assertRaises(DNSMessageError, _message_, b"\x40" + b"a" * 64 + b"\x03com\x00")
+        message = _message_(self.QNAME)
+        message.qname = "a" * 64 + ".com"
+        self.assertFalse(message.is_hostname_query())
+        self.assertTrue(_message_(b"\x3f" + b"a" * 63 + b"\x03com\x00").is_hostname_query())
+
+
+class CacheControllerTest(unittest.TestCase):
+    """
+    CacheController test with in memory cache db obj
+    """
+
+    class CacheConn(dict):
+        """
+        in memory cache db obj
+        """
+
+        def Get(self, key):
+            return self[key]
+
+        def Put(self, key, value):
+            self[key] = value
+
+    def setUp(self):
+        self.cache_conn = self.CacheConn()
+        CacheController.CACHE_CONN_MAP["a.com"] = self.cache_conn
+
+    def tearDown(self):
+        CacheController.CACHE_CONN_MAP.pop("a.com", None)
+
+    def _age_(self, seconds):
+        for key, value in list(self.cache_conn.items()):
+            cache_data = json.loads(value)
+            cache_data["timestamp"] -= seconds
+            self.cache_conn[key] = json.dumps(cache_data)
+
+    def test_record_ttl(self):
+        CacheController.set_resolve_cache("a.com", "1.1.1.1", ["2.2.2.2"], 60)
+        self.assertEqual(CacheController.get_resolve_cache("a.com", "1.1.1.1", 1, record_ttl=True), (["2.2.2.2"], 59))
+        self._age_(30)
+        self.assertEqual(CacheController.get_resolve_cache("a.com", "1.1.1.1", 1, record_ttl=True), (["2.2.2.2"], 29))
+        self._age_(31)
+        self.assertEqual(CacheController.get_resolve_cache("a.com", "1.1.1.1", 1, record_ttl=True), (None, None))
+        # cache ttl is not affected by upstream ttl
+        self.assertEqual(CacheController.get_resolve_cache("a.com", "1.1.1.1", 1)[0], ["2.2.2.2"])
+        self.assertEqual(CacheController.get_stale_resolve_cache("a.com", "1.1.1.1"), ["2.2.2.2"])
+
+    def test_record_ttl_missing(self):
+        CacheController.set_resolve_cache("a.com", "1.1.1.1", ["2.2.2.2"])
+        self.assertEqual(CacheController.get_resolve_cache("a.com", "1.1.1.1", 1, record_ttl=True), (None, None))
+
+
+class EnterpriseCipherTest(unittest.TestCase):
+    """
+    EnterpriseCipher test, DES-ECB/PKCS5 vectors are generated by pyDes
+    """
+
+    SECRET = "12345678"
+
+    # plain text -> hex cipher text
+    VECTORS = [
+        ("a", "2f1518e5843f0f69"),
+        ("www.163.com", "8a117eea2f6b3d17b447be7e1d9fd04e"),
+        # full pad block
+        ("abcdefgh", "94d4436bc3b5b693feb959b7d4642fcb"),
+        ("1.1.1.1;2.2.2.2,600", "5d9fc592ae27bb78723755c7c687e9abf16571fcc46f2387"),
+    ]
+
+    # padded plain text with invalid PKCS5 padding
+    BAD_PADDING_LIST = ["abcdefg\x00", "abcdefg\x09", "abcdef\x01\x02"]
+
+    use_c_des = False
+
+    def setUp(self):
+        if self.use_c_des and resolver.CDes is None:
+            self.skipTest("C DES is not installed")
+        self._secret_ = resolver.D_PLUS_SECRET
+        resolver.D_PLUS_SECRET = self.SECRET
+        EnterpriseCipher._local_ = threading.local()
+        EnterpriseCipher.ENCRYPTED_DOMAIN_MAP = {}
+        EnterpriseCipher.USE_C_DES = self.use_c_des
+
+    def tearDown(self):
+        resolver.D_PLUS_SECRET = self._secret_
+        EnterpriseCipher._local_ = threading.local()
+        EnterpriseCipher.ENCRYPTED_DOMAIN_MAP = {}
+        EnterpriseCipher.USE_C_DES = None
+
+    def test_encrypt(self):
+        for plain, cipher in self.VECTORS:
+            self.assertEqual(binascii.hexlify(EnterpriseCipher.encrypt(plain)), cipher)
+
+    def test_decrypt(self):
+        for plain, cipher in self.VECTORS:
+            self.assertEqual(EnterpriseCipher.decrypt(binascii.unhexlify(cipher)), plain)
+
+    def test_round_trip(self):
+        for plain in ["", "abcdefgh", "abcdefgh" * 4, "www.163.com"]:
+            self.assertEqual(EnterpriseCipher.decrypt(EnterpriseCipher.encrypt(plain)), plain)
+
+    def test_encrypt_domain_cache(self):
+        encrypted_domain = EnterpriseCipher.encrypt_domain("www.163.com")
+        self.assertEqual(binascii.hexlify(encrypted_domain), self.VECTORS[1][1])
+        self.assertIs(EnterpriseCipher.encrypt_domain("www.163.com"), encrypted_domain)
+
+    def test_bad_padding(self):
+        des_obj = pyDes.des(self.SECRET, pyDes.ECB)
+        for padded_plain in self.BAD_PADDING_LIST:
+            self.assertRaises(ValueError, EnterpriseCipher.decrypt, des_obj.encrypt(padded_plain))
+
+    def test_bad_length(self):
+        self.assertRaises(ValueError, EnterpriseCipher.decrypt, "")
+        self.assertRaises(ValueError, EnterpriseCipher.decrypt, "1234567")
+
+
+class EnterpriseCipherCDesTest(EnterpriseCipherTest):
+    """
+    EnterpriseCipher test with C DES
+    """
+
+    use_c_des = True
+
+    def test_check_c_des(self):
+        self.assertTrue(EnterpriseCipher._check_c_des_())
+
+
+class AdmissionControllerTest(unittest.TestCase):
+    """
+    AdmissionController test
+    """
+
+    # limits used by test, config name -> value
+    LIMITS = {
+        "ADMISSION_CLIENT_RATE": 1,
+        "ADMISSION_CLIENT_BURST": 3,
+        "ADMISSION_DOMAIN_RATE": 1,
+        "ADMISSION_DOMAIN_BURST": 5,
+        "ADMISSION_MAX_UPSTREAM_REQUESTS": 2,
+        "ADMISSION_MAX_BUCKETS": 4,
+    }
+
+    def setUp(self):
+        self._limits_ = dict((i, getattr(resolver, i)) for i in self.LIMITS)
+        for name, value in self.LIMITS.items():
+            setattr(resolver, name, value)
+        self._reset_()
+
+    def tearDown(self):
+        for name, value in self._limits_.items():
+            setattr(resolver, name, value)
+        self._reset_()
+
+    @classmethod
+    def _reset_(cls):
+        AdmissionController.CLIENT_BUCKET_MAP = OrderedDict()
+        AdmissionController.DOMAIN_BUCKET_MAP = OrderedDict()
+        AdmissionController.UPSTREAM_REQUESTS = 0
+        AdmissionController.COUNTERS = dict.fromkeys(AdmissionController.COUNTERS, 0)
+
+    @classmethod
+    def _acquire_(cls, domain, source_ip):
+        admitted = AdmissionController.acquire(domain, source_ip)
+        if admitted:
+            AdmissionController.release()
+        return admitted
+
+    def test_client_bucket_key(self):
+        self.assertEqual(AdmissionController._get_client_bucket_key_("1.2.3.4"), "1.2.3.0/24")
+        self.assertEqual(AdmissionController._get_client_bucket_key_("2001:db8:1:2:3::1"), "2001:db8:1:2::/64")
+        for client_ip in ("spoof-1", "1.2.3.4, 5.6.7.8", None):
+            self.assertEqual(AdmissionController._get_client_bucket_key_(client_ip),
+                             AdmissionController.INVALID_CLIENT_BUCKET_KEY)
+
+    def test_client_rate(self):
+        for i in range(3):
+            self.assertTrue(self._acquire_("a%d.com" % i, "1.2.3.%d" % i))
+        self.assertFalse(self._acquire_("b.com", "1.2.3.4"))
+        self.assertTrue(self._acquire_("b.com", "1.2.4.4"))
+        self.assertEqual(AdmissionController.get_counters()["shed_client_rate"], 1)
+        self.assertEqual(AdmissionController.get_counters()["upstream_admitted"], 4)
+
+    def test_invalid_source_ip(self):
+        admitted = [self._acquire_("a%d.com" % (i % 4), "spoof-%d" % i) for i in range(5000)]
+        self.assertEqual(sum(admitted), 3)
+        self.assertEqual(len(AdmissionController.CLIENT_BUCKET_MAP), 1)
+
+    def test_domain_rate(self):
+        for i in range(5):
+            self.assertTrue(self._acquire_("a.com", "1.2.%d.4" % i))
+        self.assertFalse(self._acquire_("a.com", "1.2.9.4"))
+        self.assertEqual(AdmissionController.get_counters()["shed_domain_rate"], 1)
+
+    def test_refill(self):
+        for i in range(3):
+            self.assertTrue(self._acquire_("a%d.com" % i, "1.2.3.4"))
+        self.assertFalse(self._acquire_("b.com", "1.2.3.4"))
+        # 2 seconds later, 2 tokens at 1 token/second
+        AdmissionController.CLIENT_BUCKET_MAP["1.2.3.0/24"][1] -= 2
+        self.assertTrue(self._acquire_("b.com", "1.2.3.4"))
+        self.assertTrue(self._acquire_("c.com", "1.2.3.4"))
+        self.assertFalse(self._acquire_("d.com", "1.2.3.4"))
+        # refill never exceeds burst
+        AdmissionController.CLIENT_BUCKET_MAP["1.2.3.0/24"][1] -= 3600
+        for i in range(3):
+            self.assertTrue(self._acquire_("e%d.com" % i, "1.2.3.4"))
+        self.assertFalse(self._acquire_("f.com", "1.2.3.4"))
+
+    def test_domain_rejection_keeps_client_token(self):
+        AdmissionController.DOMAIN_BUCKET_MAP["a.com"] = [0, time.time()]
+        self.assertFalse(self._acquire_("a.com", "1.2.3.4"))
+        self.assertEqual(AdmissionController.CLIENT_BUCKET_MAP["1.2.3.0/24"][0], 3)
+        self.assertEqual(AdmissionController.get_counters()["shed_domain_rate"], 1)
+
+    def test_concurrency(self):
+        self.assertTrue(AdmissionController.acquire("a.com", "1.2.3.4"))
+        self.assertTrue(AdmissionController.acquire("a.com", "1.2.4.4"))
+        self.assertFalse(AdmissionController.acquire("a.com", "1.2.5.4"))
+        self.assertEqual(AdmissionController.get_counters()["shed_concurrency"], 1)
+        AdmissionController.release()
+        self.assertTrue(AdmissionController.acquire("a.com", "1.2.5.4"))
+
+    def test_lru_eviction(self):
+        for i in range(4):
+            self.assertTrue(self._acquire_("a.com", "1.2.%d.4" % i))
+        # 1.2.0.0/24 is used again, so 1.2.1.0/24 is the least recently used
+        self.assertTrue(self._acquire_("b.com", "1.2.0.4"))
+        self.assertTrue(self._acquire_("b.com", "1.2.9.4"))
+        self.assertEqual(list(AdmissionController.CLIENT_BUCKET_MAP),
+                         ["1.2.2.0/24", "1.2.3.0/24", "1.2.0.0/24", "1.2.9.0/24"])
+        # used bucket keeps its tokens
+        self.assertEqual(int(AdmissionController.CLIENT_BUCKET_MAP["1.2.0.0/24"][0]), 1)
+
+    def test_counter_not_blocked_by_bucket_lock(self):
+        with AdmissionController._lock_:
+            _thread = threading.Thread(target=AdmissionController.incr_counter, args=("cache_hit",))
+            _thread.start()
+            _thread.join(1)
+            self.assertFalse(_thread.is_alive())
+        self.assertEqual(AdmissionController.get_counters()["cache_hit"], 1)
+
+    def test_source_ip(self):
+        self.assertEqual(DNSResolver("a.com", "1.1.1.1", source_ip="2.2.2.2").source_ip, "2.2.2.2")
+        self.assertEqual(DNSResolver("a.com", "1.1.1.1").source_ip, "1.1.1.1")
+
+
+class DegradedResolverTest(unittest.TestCase):
+    """
+    DNSResolver test when upstream request is rejected
+    """
+
+    def setUp(self):
+        self.cache_conn = CacheControllerTest.CacheConn()
+        CacheController.CACHE_CONN_MAP["a.com"] = self.cache_conn
+        self._backup_ip_list_ = resolver.BACKUP_IP_LIST
+        resolver.BACKUP_IP_LIST = []
+        AdmissionControllerTest._reset_()
+
+    def tearDown(self):
+        CacheController.CACHE_CONN_MAP.pop("a.com", None)
+        resolver.BACKUP_IP_LIST = self._backup_ip_list_
+        AdmissionControllerTest._reset_()
+
+    def _set_expired_cache_(self):
+        CacheController.set_resolve_cache("a.com", "1.1.1.1", ["2.2.2.2"], 60)
+        for key, value in list(self.cache_conn.items()):
+            cache_data = json.loads(value)
+            cache_data["timestamp"] -= resolver.DEFAULT_DOMAIN_CACHE_TTL + 1
+            self.cache_conn[key] = json.dumps(cache_data)
+
+    def _assert_counter_(self, name):
+        counters = AdmissionController.get_counters()
+        for i in ("degraded_stale", "degraded_backup", "degraded_empty"):
+            self.assertEqual(counters[i], int(i == name))
+
+    def test_stale(self):
+        self._set_expired_cache_()
+        resolver.BACKUP_IP_LIST = ["9.9.9.9"]
+        self.assertEqual(DNSResolver._degraded_resolver_("a.com", "1.1.1.1"),
+                         (["2.2.2.2"], resolver.ADMISSION_DEGRADED_TTL))
+        self._assert_counter_("degraded_stale")
+
+    def test_backup(self):
+        resolver.BACKUP_IP_LIST = ["9.9.9.9"]
+        self.assertEqual(DNSResolver._degraded_resolver_("a.com", "1.1.1.1"),
+                         (["9.9.9.9"], resolver.ADMISSION_DEGRADED_TTL))
+        self._assert_counter_("degraded_backup")
+
+    def test_empty(self):
+        self.assertEqual(DNSResolver._degraded_resolver_("a.com", "1.1.1.1"), ([], 0))
+        self._assert_counter_("degraded_empty")
+
+    def test_resolve_record(self):
+        self._set_expired_cache_()
+        _max_upstream_requests = resolver.ADMISSION_MAX_UPSTREAM_REQUESTS
+        resolver.ADMISSION_MAX_UPSTREAM_REQUESTS = 1
+        AdmissionController.UPSTREAM_REQUESTS = 1
+        try:
+            self.assertEqual(DNSResolver("a.com", "1.1.1.1").resolve_record(),
+                             (["2.2.2.2"], resolver.ADMISSION_DEGRADED_TTL, "a.com"))
+        finally:
+            resolver.ADMISSION_MAX_UPSTREAM_REQUESTS = _max_upstream_requests
+        self.assertEqual(AdmissionController.get_counters()["shed_concurrency"], 1)
+        self._assert_counter_("degraded_stale")
+
+
+class SourceIpTest(unittest.TestCase):
+    """
+    admission control source ip test
+    """
+
+    class Request(object):
+        """
+        http request with META only
+        """
+
+        def __init__(self, meta):
+            self.META = meta
+
+    def setUp(self):
+        self._trusted_proxy_count_ = views.ADMISSION_TRUSTED_PROXY_COUNT
+
+    def tearDown(self):
+        views.ADMISSION_TRUSTED_PROXY_COUNT = self._trusted_proxy_count_
+
+    def test_no_trusted_proxy(self):
+        views.ADMISSION_TRUSTED_PROXY_COUNT = 0
+        request = self.Request({"REMOTE_ADDR": "10.0.0.1", "HTTP_X_FORWARDED_FOR": "spoof-1, 1.1.1.1"})
+        self.assertEqual(views._get_source_ip_(request), "10.0.0.1")
+        self.assertEqual(views._get_client_ip_(request), "spoof-1")
+
+    def test_trusted_proxy(self):
+        views.ADMISSION_TRUSTED_PROXY_COUNT = 1
+        request = self.Request({"REMOTE_ADDR": "10.0.0.1", "HTTP_X_FORWARDED_FOR": "spoof-1, 1.1.1.1"})
+        self.assertEqual(views._get_source_ip_(request), "1.1.1.1")
+        views.ADMISSION_TRUSTED_PROXY_COUNT = 2
+        self.assertEqual(views._get_source_ip_(request), "spoof-1")
+        views.ADMISSION_TRUSTED_PROXY_COUNT = 3
+        self.assertEqual(views._get_source_ip_(request), "10.0.0.1")
+        self.assertEqual(views._get_source_ip_(self.Request({"REMOTE_ADDR": "10.0.0.1"})), "10.0.0.1")
@@ -1,8 +1,10 @@
 # -*- coding: UTF-8 -*-
 
 from django.conf.urls import url
-from views import resolve
+from views import resolve, dns_query, stats
 
 urlpatterns = [
     url(r'^resolve', resolve),
+    url(r'^dns-query', dns_query),
+    url(r'^stats', stats),
 ]
@@ -1,20 +1,120 @@
 # -*- coding: UTF-8 -*-
 
-from django.http import HttpResponse
+import json
+import base64
+
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotAllowed
 from django.views.decorators.csrf import csrf_exempt
 
-from httpdns.resolver import DNSResolver
+from httpdns.config import DOH_MAX_ANSWER_TTL, ADMISSION_TRUSTED_PROXY_COUNT
+from httpdns.dnsmessage import DNSMessage, DNSMessageError
+from httpdns.resolver import DNSResolver, AdmissionController
+
+
+DNS_MESSAGE_CONTENT_TYPE = "application/dns-message"
+
+
+def _get_client_ip_(request):
+    """
+    get client ip from http request(first X-Forwarded-For hop, or REMOTE_ADDR)
+    :param request:
+    :return: str
+    """
+    if "HTTP_X_FORWARDED_FOR" in request.META:
+        return request.META["HTTP_X_FORWARDED_FOR"].split(",")[0].strip()
+    return request.META["REMOTE_ADDR"]
+
+
+def _get_source_ip_(request):
+    """
+    get request source ip for admission control, it can't be set by client:
+    REMOTE_ADDR, or the X-Forwarded-For hop appended by the outermost of ADMISSION_TRUSTED_PROXY_COUNT proxies
+    :param request:
+    :return: str
+    """
+    if ADMISSION_TRUSTED_PROXY_COUNT > 0:
+        hops = [i.strip() for i in request.META.get("HTTP_X_FORWARDED_FOR", "").split(",") if i.strip()]
+        if len(hops) >= ADMISSION_TRUSTED_PROXY_COUNT:
+            return hops[-ADMISSION_TRUSTED_PROXY_COUNT]
+    return request.META["REMOTE_ADDR"]
 
 
 @csrf_exempt
 def resolve(request):
-    if "HTTP_X_FORWARDED_FOR" in request.META:
-        _client_ip = request.META["HTTP_X_FORWARDED_FOR"]
-    else:
-        _client_ip = request.META["REMOTE_ADDR"]
     domain = request.GET.get("domain")
-    client_ip = request.GET.get("client_ip") or _client_ip
+    source_ip = _get_source_ip_(request)
+    client_ip = request.GET.get("client_ip") or _get_client_ip_(request)
     ttl = request.GET.get("ttl")
     client_extra_info = request.GET.dict()
     client_extra_info.update(request.META)
-    return HttpResponse(DNSResolver(domain, client_ip, client_extra_info, ttl).resolve())
+    return HttpResponse(DNSResolver(domain, client_ip, client_extra_info, ttl, source_ip=source_ip).resolve())
+
+
+@csrf_exempt
+def dns_query(request):
+    """
+    dns over https(RFC 8484)
+    GET ?dns=base64url(message) or POST application/dns-message
+    """
+    if request.method == "GET":
+        dns_param = request.GET.get("dns")
+        if not dns_param:
+            return HttpResponseBadRequest()
+        try:
+            data = base64.urlsafe_b64decode(dns_param.encode("ascii") + b"=" * (-len(dns_param) % 4))
+        except (TypeError, ValueError):
+            return HttpResponseBadRequest()
+    elif request.method == "POST":
+        content_type = request.META.get("CONTENT_TYPE", "").split(";")[0].strip()
+        if content_type != DNS_MESSAGE_CONTENT_TYPE:
+            return HttpResponse(status=415)
+        data = request.body
+    else:
+        return HttpResponseNotAllowed(["GET", "POST"])
+    try:
+        message = DNSMessage.parse_query(data)
+    except DNSMessageError:
+        content = DNSMessage.build_format_error(data)
+        if content is None:
+            return HttpResponseBadRequest()
+        return HttpResponse(content, content_type=DNS_MESSAGE_CONTENT_TYPE)
+
+    # answer resolved for http source ip must not be shared by http caches
+    private = False
+    server_ip_list, ttl, domain = [], 0, None
+    rcode = DNSMessage.RCODE_NOERROR
+    if message.opcode != 0 or message.qclass != DNSMessage.CLASS_IN:
+        rcode = DNSMessage.RCODE_NOTIMP
+    elif not message.is_hostname_query():
+        rcode = DNSMessage.RCODE_REFUSED
+    elif message.qtype in (DNSMessage.TYPE_A, DNSMessage.TYPE_AAAA):
+        source_ip = _get_source_ip_(request)
+        client_ip = message.get_client_subnet_ip()
+        if client_ip is None:
+            client_ip = _get_client_ip_(request)
+            private = True
+        client_extra_info = request.GET.dict()
+        client_extra_info.update(request.META)
+        server_ip_list, ttl, domain = DNSResolver(message.qname, client_ip, client_extra_info,
+                                                  record_ttl=True, source_ip=source_ip).resolve_record()
+        if not server_ip_list:
+            rcode = DNSMessage.RCODE_SERVFAIL
+        ttl = min(int(ttl), DOH_MAX_ANSWER_TTL)
+    try:
+        content = message.build_response(server_ip_list, ttl, domain, rcode)
+    except DNSMessageError:
+        content = message.build_response([], 0, rcode=DNSMessage.RCODE_SERVFAIL)
+        ttl = 0
+    response = HttpResponse(content, content_type=DNS_MESSAGE_CONTENT_TYPE)
+    if private:
+        response["Cache-Control"] = "private, max-age=%d" % max(0, ttl)
+    else:
+        response["Cache-Control"] = "max-age=%d" % max(0, ttl)
+    return response
+
+
+def stats(request):
+    """
+    admission control counters of current process
+    """
+    return HttpResponse(json.dumps(AdmissionController.get_counters()), content_type="application/json")